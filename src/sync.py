@@ -1,53 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
+import functools
+import heapq
 import os
 import shutil
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
-
-
-class cd:
-    """
-    Change directories safely, go back to the previous CWD when exiting.
-
-    @see https://stackoverflow.com/a/13197763/8846676
-    """
-
-    def __init__(self, new_path, dry_run=False):
-        self.new_path = os.path.expanduser(new_path)
-        self._dry_run = dry_run
-
-    def __enter__(self):
-        if not self._dry_run:
-            self.saved_path = os.getcwd()
-            os.chdir(self.new_path)
-
-    def __exit__(self, etype, value, traceback):
-        if not self._dry_run:
-            os.chdir(self.saved_path)
+from typing import Iterable, Iterator, Union
 
 
+@functools.lru_cache(maxsize=8)
 def get_git_email(gitconfig_path: Union[Path, None] = None) -> Union[str, None]:
     """
     Get Git author username.
 
-    Falls back to GIT_AUTHOR_EMAIL then to EMAIL then to None if user.email is
-    not set in .gitconfig.
+    Asks `git config` so includes and conditional includes are honored. Reads
+    only `gitconfig_path` if given, otherwise the user's global git config, so
+    the result doesn't depend on the repository the script is run from. Falls
+    back to GIT_AUTHOR_EMAIL then to EMAIL then to None if user.email is not set.
     """
+    command = ["git", "config"]
     if gitconfig_path is None:
-        gitconfig_path = Path.home() / ".gitconfig"
-
-    config = configparser.ConfigParser()
-    config.read(gitconfig_path)
+        command += ["--global"]
+    else:
+        command += ["--file", str(gitconfig_path)]
 
     try:
-        return config.get("user", "email")
-    except configparser.NoOptionError:
-        pass
+        email = subprocess.run(
+            [*command, "--get", "user.email"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        email = None
+    if email:
+        return email
 
     try:
         return os.environ["GIT_AUTHOR_EMAIL"]
@@ -67,24 +60,42 @@ def force_init_output(output_dir: Path) -> None:
     if output_dir.is_dir():
         git_dir = output_dir / ".git"
         if git_dir.is_dir():
-            shutil.rmtree(output_dir / ".git")
+            # Move the old history out of the way and delete it in the
+            # background. Only sync_repo.dat is staged below, so the trash
+            # directory never ends up in the initial commit.
+            trash = output_dir / f".git.trash.{os.getpid()}.{time.time_ns()}"
+            try:
+                git_dir.rename(trash)
+            except OSError:
+                shutil.rmtree(git_dir)
+            else:
+                # Not a daemon, so the interpreter waits for it before exiting.
+                threading.Thread(target=shutil.rmtree, args=(trash,)).start()
     else:
         output_dir.mkdir()
 
-    with cd(output_dir):
-        subprocess.run(
-            [
-                "git",
-                "init",
-            ],
-            check=True,
-        )
-        # Create an empty file indicating this is a sync repo.
-        info_file = Path(output_dir) / "sync_repo.dat"
-        info_file.write_text("")
+    subprocess.run(["git", "-C", str(output_dir), "init", "-q"], check=True)
+    # Create an empty file indicating this is a sync repo.
+    Path(output_dir, "sync_repo.dat").write_text("")
 
-        subprocess.run(["git", "add", "-A"], check=True)
-        subprocess.run(["git", "commit", "-am", "Initial commit"], check=True)
+    # Only stage the info file, `add -A` would scan the whole work tree.
+    subprocess.run(
+        ["git", "-C", str(output_dir), "add", "--", "sync_repo.dat"], check=True
+    )
+    subprocess.run(
+        [
+            "git",
+            "-C",
+            str(output_dir),
+            "commit",
+            "-q",
+            "--no-verify",
+            "--no-gpg-sign",
+            "-m",
+            "Initial commit",
+        ],
+        check=True,
+    )
 
 
 def validate_existing_output_repo(output_dir: Path) -> bool:
@@ -107,92 +118,282 @@ def validate_existing_output_repo(output_dir: Path) -> bool:
     return True
 
 
-def commit_exists(output_dir: Path, sha: str) -> bool:
-    """Check if a commit with subject `sha` exists in a repository.
+def synced_shas(output_abs: str) -> set[str]:
+    """Collect the subject lines of every commit in a repository.
+
+    Copied commits' subject lines are the full hash of the source commit, so
+    this is the set of source commits already synced to `output_abs`. Loading
+    it once up front avoids spawning a `git log` per source commit.
 
     Args:
-        output_dir: Path to git repository.
-        sha: Subject line to search for.
+        output_abs: Absolute path to git repository.
 
     Returns:
-        Whether 1 or more commits with subject line `sha` exist.
+        All subject lines reachable from HEAD, or an empty set if the repository
+        has no commits yet.
     """
     process = subprocess.run(
         [
             "git",
             "-C",
-            str(output_dir.absolute()),
+            output_abs,
             "log",
-            "--format=format:%f",
-            f"--grep={sha}",
+            "--format=%s",
         ],
         capture_output=True,
+        check=False,
     )
-    return len(process.stdout.decode().strip())
+    return set(process.stdout.decode().split("\n"))
 
 
-def recreate_commits(identity: str, in_git_dir: Path, output_dir: Path) -> int:
-    """Copy contributions from one local repository to another.
+def git_ident(output_abs: str, variable: str) -> str:
+    """Get the `Name <email>` identity git would record in a repository.
 
-    Copy commit dates and times, but no actual data. This emulates as if the
-    commit had actually occured, without writing any data to the repository.
-    Copied commits' subject lines are the full hash of the source commit.
+    Args:
+        output_abs: Absolute path to git repository.
+        variable: Either `GIT_AUTHOR_IDENT` or `GIT_COMMITTER_IDENT`.
+
+    Returns:
+        The identity, without the trailing timestamp `git var` appends.
+    """
+    process = subprocess.run(
+        ["git", "-C", output_abs, "var", variable],
+        capture_output=True,
+        check=True,
+    )
+    return process.stdout.decode().strip().rsplit(" ", 2)[0]
+
+
+# fast-import can only commit onto a ref, so with a detached HEAD commits are
+# built on this ref and HEAD is moved to the result afterwards.
+DETACHED_REF = "refs/sync-contribution-graph/detached"
+
+
+def head_ref(output_abs: str) -> tuple[Union[str, None], Union[str, None]]:
+    """Get what HEAD points to in a repository.
 
     Args:
-        identity: Git identity to use when searching for and writing contributions.
-                  Uses the same format as `git log --author`.
-        in_git_dir: Path to root of source git repository.
-        output_dir: Path to root of target git repository.
+        output_abs: Absolute path to git repository.
 
     Returns:
-       The number of commits copied, excluding already copied commits.
+        The full ref name of the branch HEAD points to, or None if HEAD is
+        detached, and the commit HEAD points to, or None if there are no
+        commits yet.
     """
+    process = subprocess.run(
+        ["git", "-C", output_abs, "symbolic-ref", "--quiet", "HEAD"],
+        capture_output=True,
+    )
+    # Exit status 1 means HEAD is detached, anything else is a real error.
+    if process.returncode not in (0, 1):
+        raise subprocess.CalledProcessError(
+            process.returncode, process.args, process.stdout, process.stderr
+        )
+    branch = process.stdout.decode().strip() or None
+
     process = subprocess.run(
         [
             "git",
             "-C",
-            str(in_git_dir.absolute()),
-            "log",
-            "--format=format:%aD|%cD|%H",
-            "--author",
-            identity,
+            output_abs,
+            "rev-parse",
+            "--quiet",
+            "--verify",
+            "HEAD^{commit}",
         ],
         capture_output=True,
-        check=True,
     )
+    tip = process.stdout.decode().strip() or None
 
-    num_copied = 0
-    for commit in process.stdout.decode().split("\n"):
-        try:
-            author_timestamp, commit_timestamp, sha = commit.split("|")
-        except ValueError:
-            continue
+    return branch, tip
+
+
+def author_epoch(commit: tuple[bytes, bytes, str]) -> int:
+    """Get the author date of a commit as seconds since the epoch.
+
+    Args:
+        commit: `(author date, committer date, sha)` as returned by
+                `enumerate_commits`.
+    """
+    return int(commit[0].split()[0])
+
+
+def enumerate_commits(
+    identities: list[str], input_abs: str
+) -> Iterator[tuple[bytes, bytes, str]]:
+    """List contributions made by any of several identities to a local repository.
+
+    Commits are yielded as `git log` produces them, newest first, so they are
+    parsed while git is still walking history. All identities are matched in a
+    single pass over the history.
+
+    Args:
+        identities: Git identities to search for. Each uses the same format as
+                    `git log --author`.
+        input_abs: Absolute path to root of source git repository.
+
+    Yields:
+        `(author date, committer date, sha)` for every matching commit, with
+        dates as raw `<epoch> <tz offset>` bytes.
+    """
+    command = [
+        "git",
+        "-C",
+        input_abs,
+        "log",
+        "-z",
+        "--format=format:%ad%x00%cd%x00%H",
+        "--date=raw",
+    ]
+    # git log picks commits matching any of several --author patterns.
+    command += [f"--author={identity}" for identity in identities]
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        # Both fields and records are NUL separated, so every three fields
+        # make up one commit. The last field has no trailing NUL.
+        fields = []
+        pending = b""
+        while True:
+            chunk = process.stdout.read1(1 << 16)
+            if chunk:
+                *complete, pending = (pending + chunk).split(b"\0")
+                fields += complete
+            elif pending:
+                fields.append(pending)
+
+            for i in range(0, len(fields) - 2, 3):
+                yield fields[i], fields[i + 1], fields[i + 2].decode("ascii")
+            del fields[: len(fields) - len(fields) % 3]
+
+            if not chunk:
+                break
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def write_commits(commits: Iterable[tuple[bytes, bytes, str]], output_abs: str) -> int:
+    """Recreate contributions as empty commits in a local repository.
 
-        if commit_exists(output_dir, sha):
+    Copy commit dates and times, but no actual data. This emulates as if the
+    commit had actually occured, without writing any data to the repository.
+    Copied commits' subject lines are the full hash of the source commit.
+
+    All new commits are streamed through a single `git fast-import` process
+    onto the branch HEAD points to (or onto HEAD itself when it is detached),
+    rather than running `git commit` once per commit.
+
+    Args:
+        commits: `(author date, committer date, sha)` of each contribution, as
+                 returned by `enumerate_commits`.
+        output_abs: Absolute path to root of target git repository.
+
+    Returns:
+       The number of commits copied, excluding already copied commits.
+    """
+    seen_shas = synced_shas(output_abs)
+    author = git_ident(output_abs, "GIT_AUTHOR_IDENT").encode()
+    committer = git_ident(output_abs, "GIT_COMMITTER_IDENT").encode()
+    branch, tip = head_ref(output_abs)
+    if branch is None:
+        # Drop any leftover from an interrupted sync, fast-import won't move a
+        # ref to an unrelated commit.
+        subprocess.run(
+            ["git", "-C", output_abs, "update-ref", "-d", DETACHED_REF], check=True
+        )
+    ref = (branch or DETACHED_REF).encode()
+    # Only the dates and message differ between commits, build the rest of
+    # each fast-import command once.
+    header = b"commit %s\nauthor %s " % (ref, author)
+    committer_prefix = b"\ncommitter %s " % committer
+
+    fast_import = subprocess.Popen(
+        ["git", "-C", output_abs, "fast-import", "--quiet"],
+        stdin=subprocess.PIPE,
+    )
+    num_copied = 0
+    for author_timestamp, commit_timestamp, sha in commits:
+        if sha in seen_shas:
             # TODO: Do proper logging here.
             print(f"Commit for {sha} already exists. Skipping...", file=sys.stderr)
             continue
 
-        command = [
-            "git",
-            "-C",
-            str(output_dir.absolute()),
-            "commit",
-            "--allow-empty",
-            "-m",
-            sha,
-        ]
-        env = {
-            **os.environ.copy(),
-            "GIT_AUTHOR_DATE": author_timestamp,
-            "GIT_COMITER_DATE": commit_timestamp,
-        }
-        subprocess.run(command, env=env, check=True)
+        message = f"{sha}\n".encode()
+        command = b"%s%s%s%s\ndata %d\n%s" % (
+            header,
+            author_timestamp,
+            committer_prefix,
+            commit_timestamp,
+            len(message),
+            message,
+        )
+        if num_copied == 0 and tip is not None:
+            # fast-import starts new refs from scratch, continue the existing
+            # history instead.
+            command += b"from %s\n" % tip.encode()
+        fast_import.stdin.write(command + b"\n")
+        seen_shas.add(sha)
         num_copied += 1
 
+    fast_import.stdin.close()
+    if fast_import.wait() != 0:
+        raise subprocess.CalledProcessError(fast_import.returncode, fast_import.args)
+
+    if branch is None and num_copied:
+        new_tip = (
+            subprocess.run(
+                ["git", "-C", output_abs, "rev-parse", DETACHED_REF],
+                capture_output=True,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+        subprocess.run(
+            ["git", "-C", output_abs, "update-ref", "--no-deref", "HEAD", new_tip],
+            check=True,
+        )
+        subprocess.run(
+            ["git", "-C", output_abs, "update-ref", "-d", DETACHED_REF], check=True
+        )
+
     return num_copied
 
 
+def sync_locals(inputs: list[str], output_abs: str, identities: list[str]) -> int:
+    """Copy contributions from several local repositories to another.
+
+    Sources are scanned concurrently, each by its own `git log`, and their
+    commits are merged oldest author date first into the output repository.
+    Writing to the output repository stays serialized.
+
+    Args:
+        inputs: Absolute paths to roots of source git repositories.
+        output_abs: Absolute path to root of target git repository.
+        identities: Git identities to use when searching for contributions. Each
+                    uses the same format as `git log --author`.
+
+    Returns:
+       The number of commits copied, excluding already copied commits.
+    """
+
+    def scan(input_abs: str) -> list[tuple[bytes, bytes, str]]:
+        # Sorting needs the whole scan. Reverse `git log` order before the
+        # stable sort so commits sharing an author date keep parents ahead of
+        # children.
+        commits = list(enumerate_commits(identities, input_abs))
+        commits.reverse()
+        commits.sort(key=author_epoch)
+        return commits
+
+    # Scanning is spent waiting on git, so threads overlap fine.
+    max_workers = max(1, (os.cpu_count() or 4) * 3 // 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scans = list(executor.map(scan, inputs))
+
+    return write_commits(heapq.merge(*scans, key=author_epoch), output_abs)
+
+
 def add_generic_arg(parsers: list[argparse.ArgumentParser], *args, **kwargs) -> None:
     """Apply adding an argument to multiple argparse subparses simultaneously."""
     for p in parsers:
@@ -211,14 +412,15 @@ def sync_gitlab(cli_args) -> None:
 
 def sync_local(cli_args) -> None:
     """Sync contribution from a local repository to another local repository."""
-    input_path = Path(cli_args.INPUT_REPO)
-    output_path = cli_args.DESTINATION_REPO
-    identity = cli_args.identity
+    # Resolve paths once here, everything below passes them straight to git.
+    input_abs = [os.fspath(Path(p).resolve()) for p in cli_args.INPUT_REPO]
+    output_abs = os.fspath(Path(cli_args.DESTINATION_REPO).resolve())
+    identities = cli_args.identity
 
-    recreate_commits(identity, input_path, output_path)
+    sync_locals(input_abs, output_abs, identities)
 
     # TODO: Proper logging
-    # print(f"Finished copying commits from {input_path} to {output_path}")
+    # print(f"Finished copying commits from {input_abs} to {output_abs}")
 
 
 if __name__ == "__main__":
@@ -245,10 +447,17 @@ if __name__ == "__main__":
         "local",
         help="Pull contributions from an existing repository on disk.",
     )
-    parser_local.add_argument("INPUT_REPO", help="Path to input repository.")
+    parser_local.add_argument(
+        "INPUT_REPO", nargs="+", help="Paths to one or more input repositories."
+    )
     parser_local.add_argument(
         "--identity",
-        help="Git identity to use when finding commits. Same format as `git log --author`.",
+        action="append",
+        help="""\
+        Git identity to use when finding commits. Same format as
+        `git log --author`. May be given multiple times to match any of
+        several identities.
+        """,
     )
 
     # Generic arguments --------------------------------------------------------
@@ -286,11 +495,15 @@ if __name__ == "__main__":
     # TODO: Use log library for this
     QUIET = args.quiet
 
+    if args.identity is None:
+        email = get_git_email()
+        if email is None:
+            parser.error("could not determine a git identity, pass --identity")
+        args.identity = [email]
+
     args.DESTINATION_REPO = Path(args.DESTINATION_REPO)
     if args.force:
         force_init_output(args.DESTINATION_REPO)
-    if args.identity is None:
-        args.identity = get_git_email()
 
     validate_existing_output_repo(args.DESTINATION_REPO)
 